@@ -2,9 +2,23 @@
 Utility functions for Databricks ai_query integration.
 Enables querying structured table data using natural language.
 """
+import atexit
+import base64
+import collections
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
 import logging
 import os
-from databricks import sql
+import queue
+import re
+import string
+import threading
+import time
+from typing import Literal
+import pyarrow as pa
 from databricks.sdk.core import Config
 
 logger = logging.getLogger(__name__)
@@ -15,6 +29,51 @@ DEFAULT_SCHEMA = "analytics"
 DEFAULT_TABLE = "measureresponses_impairment"
 DEFAULT_ENDPOINT = "databricks-gpt-oss-120b"
 
+# SQL warehouse used for queries; read once, see _get_warehouse_id for the fallback
+WAREHOUSE_ID = os.getenv('DATABRICKS_WAREHOUSE_ID')
+
+# How long an auto-selected warehouse is reused before the workspace is listed again
+WAREHOUSE_CACHE_TTL_SECONDS = 60
+
+# Statements are submitted asynchronously and polled with exponential backoff
+STATEMENT_POLL_INITIAL_SECONDS = 0.1
+STATEMENT_POLL_MAX_SECONDS = 2.0
+STATEMENT_TIMEOUT_SECONDS = 300
+
+# Rows pulled from the warehouse per Arrow fetch
+FETCH_BATCH_ROWS = 10_000
+
+# HTTP transport tuning, overridable per deployment through app.yaml
+POOL_MAXSIZE = int(os.getenv('DATABRICKS_POOL_MAXSIZE', '50'))
+POOL_CONNECTIONS = int(os.getenv('DATABRICKS_POOL_CONNECTIONS', '10'))
+SQL_SOCKET_TIMEOUT_SECONDS = int(os.getenv('DATABRICKS_SQL_SOCKET_TIMEOUT', '300'))
+SQL_RETRY_ATTEMPTS = int(os.getenv('DATABRICKS_SQL_RETRY_ATTEMPTS', '5'))
+
+# Optional precomputed BOOLEAN column marking rows with non-empty response text, e.g.
+#   koo_responseextended IS NOT NULL AND length(trim(koo_responseextended)) > 0
+# maintained by the table's pipeline and used for clustering (OPTIMIZE ... ZORDER BY).
+# When set, sampling filters on it so the warehouse can skip files instead of
+# trimming every row of the table before applying LIMIT.
+HAS_TEXT_COLUMN = os.getenv('IMPAIRMENT_HAS_TEXT_COLUMN')
+
+# Optional fully qualified name of a Delta table holding only the default table's
+# rows with non-empty response text, e.g. maintained by the pipeline as
+#   CREATE OR REPLACE TABLE ... AS SELECT * FROM measureresponses_impairment
+#   WHERE koo_responseextended IS NOT NULL AND length(trim(koo_responseextended)) > 0
+# When set, sample/analysis/general queries read it without any WHERE clause or
+# TABLESAMPLE, so LIMIT lets the warehouse stop after the first few rows.
+FILTERED_TABLE = os.getenv('IMPAIRMENT_FILTERED_TABLE')
+
+# Optional percentage for a seeded TABLESAMPLE in sample/analysis/general queries,
+# spreading the sampled rows across the table instead of taking whichever rows are
+# read first. Off by default: row-level sampling still reads every file, so it is
+# slower than LIMIT alone. Size it from the row count of the table being sampled
+# so the slice comfortably exceeds the LIMITs used here (at most 10 rows), e.g.
+# 0.01 for ~4.9M rows; too small a percentage yields an empty sample. FILTERED_TABLE
+# is never sampled.
+SAMPLE_PERCENT = float(os.getenv('IMPAIRMENT_SAMPLE_PERCENT') or 0)
+SAMPLE_SEED = 42
+
 # Table schema information for context
 TABLE_SCHEMA_INFO = """
 Table: dev_structured.analytics.measureresponses_impairment
@@ -34,137 +93,734 @@ that may mention disabilities, impairments, or health conditions.
 """
 
 
+# Prompt for answering a question from data already fetched from the table
+_PROMPT_TEMPLATE = string.Template("""You are a healthcare data analyst assistant analyzing the measureresponses_impairment table.
+
+Here is the actual data from the database:
+$data
+
+User question: $question
+
+Based on the actual data provided above, please answer the user's question directly and accurately.""")
+
+AI_QUERY_WITH_DATA_SQL = "SELECT ai_query(:endpoint, :prompt) AS response"
+
+# Smallest possible ai_query, used to warm the warehouse and the model endpoint
+AI_QUERY_WARM_UP_SQL = (
+    "SELECT ai_query(:endpoint, :prompt, modelParameters => named_struct('max_tokens', 1)) AS response"
+)
+
+# Fixed instructions placed around the user's question in batched row analysis
+_ANALYSIS_PROMPT_PREFIX = (
+    "Analyze each of these healthcare response records and answer the following "
+    "question for each one: "
+)
+_ANALYSIS_RESPONSE_FORMAT = (
+    "\n\nRespond with ONLY a JSON array containing one object per record, each with "
+    "the keys \"id\" (the record id, unchanged) and \"analysis\" (your answer for that record)."
+)
+
+# Batched row-analysis statement. The endpoint and the instruction (including the
+# user's question) are bound parameters, so the text only varies with table settings.
+_DATA_ANALYSIS_SQL_TEMPLATE = string.Template(r"""
+WITH sampled AS (
+    SELECT 
+        koo_chimeasureresponseid,
+        koo_responseextended
+    FROM $source $tablesample
+    $text_filter
+    LIMIT $limit
+),
+batched AS (
+    SELECT 
+        FLOOR((ROW_NUMBER() OVER (ORDER BY koo_chimeasureresponseid) - 1) / $batch_size) AS batch_id,
+        koo_chimeasureresponseid,
+        koo_responseextended
+    FROM sampled
+),
+prompts AS (
+    SELECT 
+        batch_id,
+        collect_list(named_struct(
+            'id', koo_chimeasureresponseid,
+            'preview', SUBSTRING(koo_responseextended, 1, 100)
+        )) AS records,
+        to_json(collect_list(named_struct(
+            'id', koo_chimeasureresponseid,
+            'text', koo_responseextended
+        ))) AS records_json
+    FROM batched
+    GROUP BY batch_id
+)
+SELECT 
+    records,
+    ai_query(
+        :endpoint,
+        CONCAT(:instruction, '\n\nRecords (JSON):\n', records_json)
+    ) AS analysis
+FROM prompts
+ORDER BY batch_id
+""".strip())
+
+
+# Sample fetch and ai_query fused into a single statement for general questions, so
+# answering takes one warehouse round-trip. The prompt is assembled in SQL from the
+# same pieces as _PROMPT_TEMPLATE; the pieces and the question are bound parameters.
+# Several questions asked at once get one result row each, answered from the same
+# sample by ai_query calls the warehouse batches together.
+_GENERAL_QUERY_SQL_TEMPLATE = string.Template(r"""
+WITH sampled AS (
+    SELECT 
+        koo_chimeasureresponseid,
+        koo_clientid,
+        SUBSTRING(koo_responseextended, 1, $preview_chars) AS koo_responseextended_preview,
+        koo_appcode,
+        createdon
+    FROM $source $tablesample
+    $text_filter
+    LIMIT $limit
+),
+context AS (
+    SELECT 
+        collect_list(struct(
+            koo_chimeasureresponseid,
+            koo_clientid,
+            koo_responseextended_preview,
+            koo_appcode,
+            createdon
+        )) AS records,
+        CASE
+            WHEN COUNT(koo_responseextended_preview) = 0 THEN :empty_context
+            ELSE CONCAT(:context_header, concat_ws('\n', transform(
+                collect_list(koo_responseextended_preview),
+                (text, i) -> CONCAT('Record ', i + 1, ': ', text, '...')
+            )))
+        END AS data_context
+    FROM sampled
+)
+SELECT 
+    records,
+    ai_query(:endpoint, CONCAT(:prompt_prefix, data_context, questions.prompt_suffix)) AS response
+FROM context
+CROSS JOIN (
+    SELECT posexplode(array($prompt_suffixes)) AS (question_index, prompt_suffix)
+) AS questions
+ORDER BY question_index
+""".strip())
+
+# _PROMPT_TEMPLATE split around the data it embeds, for prompts assembled in SQL
+_PROMPT_PREFIX, _prompt_suffix = _PROMPT_TEMPLATE.template.split("$data")
+_PROMPT_SUFFIX_TEMPLATE = string.Template(_prompt_suffix)
+
+
 def get_table_info() -> str:
     """Return table schema information for display."""
     return TABLE_SCHEMA_INFO
 
 
+@functools.lru_cache(maxsize=1)
 def _get_databricks_config() -> Config:
-    """Get Databricks configuration."""
-    return Config()
+    """
+    Get Databricks configuration, with the SDK's HTTP connection pool sized for concurrent sessions.
+    
+    Resolving a Config reads the environment and config files and runs auth
+    discovery, and none of that changes during the process, so it is built once.
+    """
+    return Config(
+        max_connection_pools=POOL_CONNECTIONS,
+        max_connections_per_pool=POOL_MAXSIZE
+    )
+
+
+# Warehouse picked when DATABRICKS_WAREHOUSE_ID is not configured, as (warehouse_id, expires_at)
+_warehouse_pick = None
+_warehouse_pick_lock = threading.Lock()
 
 
-def _execute_sql_with_user_token(query: str, user_token: str) -> dict:
+def _pick_running_warehouse_id() -> str:
     """
-    Execute a SQL query using the user's access token for authentication.
-    This method ensures the query runs with the user's permissions.
+    Return the id of a SQL warehouse to use, reusing the last pick for a short TTL.
+    
+    A RUNNING warehouse is preferred; otherwise any usable warehouse is returned,
+    since a stopped warehouse is started by the first query sent to it. Listing
+    warehouses is a REST round-trip, so the choice is cached for
+    WAREHOUSE_CACHE_TTL_SECONDS instead of being repeated for every query.
+    
+    Returns:
+        The warehouse id, or None if the workspace has no usable warehouse.
+    """
+    global _warehouse_pick
+    with _warehouse_pick_lock:
+        if _warehouse_pick and _warehouse_pick[1] > time.monotonic():
+            return _warehouse_pick[0]
+        
+        # Imported here: the full client pulls in every service module and is only
+        # needed when DATABRICKS_WAREHOUSE_ID is not configured.
+        from databricks.sdk import WorkspaceClient
+        
+        # The SDK has no server-side state filter, so stop at the first RUNNING match
+        # rather than materializing the whole paginated listing.
+        w = WorkspaceClient(config=_get_databricks_config())
+        warehouse = next(
+            (wh for wh in w.warehouses.list() if wh.state and wh.state.value == "RUNNING"),
+            None
+        )
+        if warehouse is None:
+            warehouse = next(
+                (wh for wh in w.warehouses.list()
+                 if not (wh.state and wh.state.value in ("DELETING", "DELETED"))),
+                None
+            )
+        if warehouse is None:
+            return None
+        
+        logger.info(f"Auto-selected SQL warehouse {warehouse.id}")
+        _warehouse_pick = (warehouse.id, time.monotonic() + WAREHOUSE_CACHE_TTL_SECONDS)
+        return warehouse.id
+
+
+def _invalidate_warehouse_pick() -> bool:
+    """Forget the auto-selected warehouse. Returns True if there was one to forget."""
+    global _warehouse_pick
+    with _warehouse_pick_lock:
+        had_pick = _warehouse_pick is not None
+        _warehouse_pick = None
+    return had_pick
+
+
+def _get_warehouse_id() -> str:
+    """Return the configured warehouse id, falling back to one picked from the workspace."""
+    return WAREHOUSE_ID or _pick_running_warehouse_id()
+
+
+# Warehouse connections are pooled per (host, warehouse, principal), so each
+# question does not pay a fresh TLS handshake and session setup.
+POOL_SIZE = 5
+POOL_MAX_OVERFLOW = 5
+POOL_TIMEOUT_SECONDS = 30
+# Idle connections older than this are pinged with SELECT 1 before reuse
+POOL_PRE_PING_IDLE_SECONDS = 60
+
+# Answers to (question, data context) pairs are reused for a while, LRU-evicted
+AI_QUERY_CACHE_SIZE = 512
+AI_QUERY_CACHE_TTL_SECONDS = 600
+
+# The table's row count changes slowly, so it is reused for a few minutes, LRU-evicted
+COUNT_CACHE_SIZE = 256
+COUNT_CACHE_TTL_SECONDS = 300
+
+# Pools for user tokens that expire within this window are closed instead of reused
+TOKEN_REFRESH_MARGIN_SECONDS = 30
+
+# At most this many pools are kept; beyond it the least recently used one is
+# closed, so pools for tokens without a readable expiry do not pile up
+POOL_MAX_POOLS = 32
+
+# Set for the duration of a query_impairment_data(no_store=True) call: nothing
+# derived from the request (connections, counts, answers) is kept afterwards
+_no_store = contextvars.ContextVar("no_store", default=False)
+
+
+def _principal_key(user_token: str = None) -> str:
+    """Return a cache key for the authenticating principal without keeping the raw token."""
+    if not user_token:
+        return "service_principal"
+    return hashlib.blake2b(user_token.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _token_expiry(user_token: str = None) -> float:
+    """Return the `exp` claim of a JWT access token as a Unix timestamp, or None if unknown."""
+    if not user_token:
+        return None
+    try:
+        payload = user_token.split(".")[1]
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return float(claims["exp"])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _close_quietly(connection) -> None:
+    """Close a connection, logging rather than raising on failure."""
+    try:
+        connection.close()
+    except Exception as e:
+        logger.debug(f"Error closing connection: {e}")
+
+
+def _shared_cursor(connection):
+    """
+    Return the cursor kept on a pooled connection, opening it on first use.
+    
+    A connection is only used by one caller at a time while checked out, so a
+    single cursor can serve every query on it instead of a new cursor per query.
+    """
+    cursor = getattr(connection, "_app_shared_cursor", None)
+    if cursor is None or not getattr(cursor, "open", True):
+        cursor = connection.cursor()
+        connection._app_shared_cursor = cursor
+    return cursor
+
+
+def _is_alive(connection) -> bool:
+    """Check that a pooled connection still works by running SELECT 1."""
+    try:
+        cursor = _shared_cursor(connection)
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        return True
+    except Exception as e:
+        logger.info(f"Discarding stale warehouse connection: {e}")
+        return False
+
+
+class _ConnectionPool:
+    """
+    Bounded pool of warehouse connections sharing one set of credentials.
+    
+    Up to POOL_SIZE idle connections are kept; under load up to POOL_MAX_OVERFLOW
+    more are opened and closed again when returned. Beyond that, checkout waits
+    up to POOL_TIMEOUT_SECONDS for a connection to be returned.
+    """
+    
+    def __init__(self, connect, expires_at: float = None):
+        self._connect = connect
+        self.expires_at = expires_at
+        self.closed = False
+        # LIFO so the most recently used (least likely stale) connection is reused first
+        self._idle = queue.LifoQueue(maxsize=POOL_SIZE)
+        self._slots = threading.BoundedSemaphore(POOL_SIZE + POOL_MAX_OVERFLOW)
+    
+    def checkout(self):
+        """Return a healthy connection, reusing an idle one when possible."""
+        if not self._slots.acquire(timeout=POOL_TIMEOUT_SECONDS):
+            raise TimeoutError(f"No warehouse connection became available within {POOL_TIMEOUT_SECONDS} seconds")
+        try:
+            while True:
+                try:
+                    connection, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - last_used < POOL_PRE_PING_IDLE_SECONDS or _is_alive(connection):
+                    return connection
+                _close_quietly(connection)
+        except Exception:
+            self._slots.release()
+            raise
+    
+    def checkin(self, connection, healthy: bool = True) -> None:
+        """Return a connection to the pool, closing it if broken, surplus, or the pool is closed."""
+        try:
+            if healthy and not self.closed:
+                try:
+                    self._idle.put_nowait((connection, time.monotonic()))
+                    return
+                except queue.Full:
+                    pass
+            _close_quietly(connection)
+        finally:
+            self._slots.release()
+    
+    def close(self) -> None:
+        """Close idle connections; connections still checked out are closed on return."""
+        self.closed = True
+        while True:
+            try:
+                connection, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            _close_quietly(connection)
+
+
+class _WarehouseConnectError(Exception):
+    """Raised when no connection to the warehouse could be opened, before any statement was submitted."""
+
+
+def _connect(cfg: Config, warehouse_id: str, user_token: str = None):
+    """Open a new warehouse connection, as the user when a token is given, else as the service principal."""
+    # Deferred so importing this module (e.g. for General Chat only) stays cheap
+    from databricks import sql
+    
+    if user_token:
+        auth = {"access_token": user_token}
+    else:
+        auth = {"credentials_provider": lambda: cfg.authenticate}
+    
+    try:
+        return sql.connect(
+            server_hostname=cfg.host,
+            http_path=f"/sql/1.0/warehouses/{warehouse_id}",
+            _socket_timeout=SQL_SOCKET_TIMEOUT_SECONDS,
+            _retry_stop_after_attempts_count=SQL_RETRY_ATTEMPTS,
+            **auth
+        )
+    except Exception as e:
+        raise _WarehouseConnectError(f"Could not connect to warehouse {warehouse_id}: {e}") from e
+
+
+# (host, warehouse, principal) -> pool, least recently used first
+_pools = collections.OrderedDict()
+_pools_lock = threading.Lock()
+
+
+def _get_pool(cfg: Config, warehouse_id: str, user_token: str = None) -> _ConnectionPool:
+    """
+    Return the connection pool for these credentials, creating it if needed.
+    
+    User tokens are short-lived and the proxy issues a new one when they expire,
+    so pools for tokens about to expire are closed rather than kept forever, and
+    only the POOL_MAX_POOLS most recently used pools are kept.
+    
+    Args:
+        cfg: Databricks configuration used for the host and service principal auth
+        warehouse_id: The SQL warehouse to connect to
+        user_token: The user's access token; when omitted the service principal is used
+    """
+    key = (cfg.host, warehouse_id, _principal_key(user_token))
+    refresh_before = time.time() + TOKEN_REFRESH_MARGIN_SECONDS
+    with _pools_lock:
+        expired = [
+            pool_key for pool_key, pool in _pools.items()
+            if pool_key != key and pool.expires_at is not None and pool.expires_at <= refresh_before
+        ]
+        stale = [_pools.pop(pool_key) for pool_key in expired]
+        
+        pool = _pools.get(key)
+        if pool is None:
+            connect = functools.partial(_connect, cfg, warehouse_id, user_token)
+            pool = _ConnectionPool(connect, _token_expiry(user_token))
+            _pools[key] = pool
+        _pools.move_to_end(key)
+        while len(_pools) > POOL_MAX_POOLS:
+            stale.append(_pools.popitem(last=False)[1])
+    
+    for stale_pool in stale:
+        stale_pool.close()
+    return pool
+
+
+@contextlib.contextmanager
+def _checkout(cfg: Config, warehouse_id: str, user_token: str = None):
+    """
+    Check a connection out of the matching pool for the duration of a with-block.
+    
+    Under no-store, a one-off connection is opened and closed instead, so no pool
+    holds on to the request's token.
+    """
+    if _no_store.get():
+        connection = _connect(cfg, warehouse_id, user_token)
+        try:
+            yield connection
+        finally:
+            _close_quietly(connection)
+        return
+    
+    pool = _get_pool(cfg, warehouse_id, user_token)
+    connection = pool.checkout()
+    # Any exception, including BaseExceptions such as Streamlit stopping the script,
+    # returns the connection as broken so its slot is always released
+    healthy = False
+    try:
+        yield connection
+        healthy = True
+    finally:
+        pool.checkin(connection, healthy=healthy)
+
+
+def close_all() -> None:
+    """Close every pooled warehouse connection. Called automatically at interpreter exit."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_all)
+
+
+class _StaleConnectionError(Exception):
+    """Raised when a statement could not be submitted because its connection was dropped."""
+
+
+def _submit_statement(cursor, query: str, parameters: dict = None) -> None:
+    """
+    Submit a statement asynchronously, without waiting for it to run.
     
     Args:
+        cursor: An open databricks.sql cursor
         query: The SQL statement to execute
-        user_token: The user's access token from X-Forwarded-Access-Token header
+        parameters: Values for named parameter markers (`:name`) in the query
+        
+    Raises:
+        _StaleConnectionError: If the connection was dropped before the statement
+            was accepted, so it can safely be submitted again on another connection.
+    """
+    try:
+        cursor.execute_async(query, parameters)
+    except Exception as e:
+        if _is_disconnect_error(e):
+            raise _StaleConnectionError(str(e)) from e
+        raise
+
+
+def _wait_for_statement(cursor) -> None:
+    """
+    Poll a submitted statement until it finishes.
+    
+    Polling (instead of a blocking execute) lets a long-running ai_query be
+    cancelled on the warehouse once STATEMENT_TIMEOUT_SECONDS is exceeded.
+    
+    Raises:
+        TimeoutError: If the statement is still pending after the timeout.
+    """
+    delay = STATEMENT_POLL_INITIAL_SECONDS
+    deadline = time.monotonic() + STATEMENT_TIMEOUT_SECONDS
+    while cursor.is_query_pending():
+        if time.monotonic() >= deadline:
+            cursor.cancel()
+            raise TimeoutError(f"SQL statement did not finish within {STATEMENT_TIMEOUT_SECONDS} seconds")
+        time.sleep(delay)
+        delay = min(delay * 2, STATEMENT_POLL_MAX_SECONDS)
+    
+    # Raises if the statement failed; otherwise makes the result set fetchable
+    cursor.get_async_execution_result()
+
+
+def _fetch_arrow(cursor) -> pa.Table:
+    """
+    Read the full result set as an Arrow table, FETCH_BATCH_ROWS rows at a time.
+    
+    Results stay columnar; callers convert to Python rows only where needed
+    with `Table.to_pylist()`, or iterate `Table.to_batches()`.
+    """
+    chunks = [cursor.fetchmany_arrow(FETCH_BATCH_ROWS)]
+    while chunks[-1].num_rows == FETCH_BATCH_ROWS:
+        chunks.append(cursor.fetchmany_arrow(FETCH_BATCH_ROWS))
+    return pa.concat_tables(chunks) if len(chunks) > 1 else chunks[0]
+
+
+# Transport (socket/urllib3) and thrift messages for a dropped connection or session
+_DISCONNECT_ERROR_RE = re.compile(
+    r"broken pipe|connection reset by peer|connection aborted|"
+    r"remote end closed connection|invalid sessionhandle",
+    re.IGNORECASE
+)
+
+
+def _is_disconnect_error(error: Exception) -> bool:
+    """
+    Return True if an error means the connection was dropped rather than the statement failing.
+    
+    The exception chain is inspected by type and message because the connector
+    wraps thrift/urllib3 transport errors in its own exception classes.
+    """
+    while error is not None:
+        if isinstance(error, ConnectionError) or type(error).__name__ == "TTransportException":
+            return True
+        if _DISCONNECT_ERROR_RE.search(str(error)):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def _execute_on_warehouse(query: str, parameters: dict = None, user_token: str = None) -> dict:
+    """
+    Execute a SQL query on the configured warehouse and return the Arrow result.
+    
+    Shared by the user-token and service-principal paths, which differ only in
+    the credentials used for the pooled connection. A connection that turns out
+    to be stale when the statement is submitted is evicted from the pool and the
+    submission retried once on a fresh one, so long-idle sessions do not surface
+    as user-visible errors. Failures after submission are never retried, so a
+    statement (and any ai_query in it) cannot run twice.
+    
+    Args:
+        query: The SQL statement to execute
+        parameters: Values for named parameter markers (`:name`) in the query
+        user_token: The user's access token; when omitted the service principal is used
         
     Returns:
         Dictionary containing the query results or error information.
     """
     try:
         cfg = _get_databricks_config()
-        warehouse_id = os.getenv('DATABRICKS_WAREHOUSE_ID')
+        warehouse_id = _get_warehouse_id()
         
         if not warehouse_id:
             return {
                 "success": False,
-                "error": "DATABRICKS_WAREHOUSE_ID environment variable is not set. Please configure it in app.yaml."
+                "error": "DATABRICKS_WAREHOUSE_ID environment variable is not set and no SQL warehouse was found. Please configure it in app.yaml."
             }
         
-        if not user_token:
-            return {
-                "success": False,
-                "error": "User access token not available. Please ensure you are running in a Databricks App environment."
-            }
+        for attempt in (0, 1):
+            try:
+                # A failing with-block checks the connection back in as broken, closing it
+                with _checkout(cfg, warehouse_id, user_token) as connection:
+                    cursor = _shared_cursor(connection)
+                    _submit_statement(cursor, query, parameters)
+                    _wait_for_statement(cursor)
+                    table = _fetch_arrow(cursor)
+                break
+            except _StaleConnectionError as e:
+                if attempt:
+                    raise
+                logger.warning(f"Warehouse connection was stale, reconnecting: {e}")
         
-        with sql.connect(
-            server_hostname=cfg.host,
-            http_path=f"/sql/1.0/warehouses/{warehouse_id}",
-            access_token=user_token
-        ) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                df = cursor.fetchall_arrow().to_pandas()
-                
-                # Convert DataFrame to list of dictionaries
-                results = df.to_dict('records')
-                
-                return {
-                    "success": True,
-                    "results": results,
-                    "row_count": len(results)
-                }
+        return {
+            "success": True,
+            "arrow_table": table,
+            "row_count": table.num_rows
+        }
+    
+    except _WarehouseConnectError as e:
+        # Nothing was submitted, so the caller may safely retry on another warehouse
+        logger.error(f"Error connecting to SQL warehouse: {e}")
+        return {
+            "success": False,
+            "error": str(e),
+            "warehouse_unavailable": True
+        }
                 
     except Exception as e:
-        logger.error(f"Error executing SQL: {e}")
+        principal = "user token" if user_token else "service principal"
+        logger.error(f"Error executing SQL with {principal}: {e}")
         return {
             "success": False,
             "error": str(e)
         }
 
 
-def _execute_sql_with_service_principal(query: str) -> dict:
+def _execute_sql_with_user_token(query: str, user_token: str, parameters: dict = None) -> dict:
     """
-    Execute a SQL query using Service Principal credentials.
-    Fallback method when user token is not available.
+    Execute a SQL query using the user's access token for authentication.
+    This method ensures the query runs with the user's permissions.
     
     Args:
         query: The SQL statement to execute
+        user_token: The user's access token from X-Forwarded-Access-Token header
+        parameters: Values for named parameter markers (`:name`) in the query
         
     Returns:
         Dictionary containing the query results or error information.
     """
-    try:
-        cfg = _get_databricks_config()
-        warehouse_id = os.getenv('DATABRICKS_WAREHOUSE_ID')
-        
-        if not warehouse_id:
-            return {
-                "success": False,
-                "error": "DATABRICKS_WAREHOUSE_ID environment variable is not set. Please configure it in app.yaml."
-            }
-        
-        with sql.connect(
-            server_hostname=cfg.host,
-            http_path=f"/sql/1.0/warehouses/{warehouse_id}",
-            credentials_provider=lambda: cfg.authenticate
-        ) as connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                df = cursor.fetchall_arrow().to_pandas()
-                
-                # Convert DataFrame to list of dictionaries
-                results = df.to_dict('records')
-                
-                return {
-                    "success": True,
-                    "results": results,
-                    "row_count": len(results)
-                }
-                
-    except Exception as e:
-        logger.error(f"Error executing SQL with service principal: {e}")
+    if not user_token:
         return {
             "success": False,
-            "error": str(e)
+            "error": "User access token not available. Please ensure you are running in a Databricks App environment."
         }
+    return _execute_on_warehouse(query, parameters, user_token)
+
+
+def _execute_sql_with_service_principal(query: str, parameters: dict = None) -> dict:
+    """
+    Execute a SQL query using Service Principal credentials.
+    Fallback method when user token is not available.
+    
+    Args:
+        query: The SQL statement to execute
+        parameters: Values for named parameter markers (`:name`) in the query
+        
+    Returns:
+        Dictionary containing the query results or error information.
+    """
+    return _execute_on_warehouse(query, parameters)
+
+
+# Keyword patterns used to route questions, compiled once. Plain substrings as
+# before (no word boundaries), matched case-insensitively in a single scan.
+_COUNT_QUESTION_RE = re.compile(
+    r"how many|count|number of|total|records in|rows in|entries in|how much",
+    re.IGNORECASE
+)
+_SAMPLE_QUESTION_RE = re.compile(
+    r"show me|example|sample|give me|list|what are|display|fetch",
+    re.IGNORECASE
+)
 
 
 def _is_count_question(question: str) -> bool:
     """Check if the question is asking for a count or number of records."""
-    question_lower = question.lower()
-    count_patterns = [
-        'how many', 'count', 'number of', 'total', 'records in',
-        'rows in', 'entries in', 'how much'
-    ]
-    return any(pattern in question_lower for pattern in count_patterns)
+    return _COUNT_QUESTION_RE.search(question) is not None
 
 
 def _is_sample_question(question: str) -> bool:
     """Check if the question is asking for sample data or examples."""
-    question_lower = question.lower()
-    sample_patterns = [
-        'show me', 'example', 'sample', 'give me', 'list',
-        'what are', 'display', 'fetch'
-    ]
-    return any(pattern in question_lower for pattern in sample_patterns)
+    return _SAMPLE_QUESTION_RE.search(question) is not None
 
 
+def _split_questions(question: str) -> list:
+    """
+    Split a prompt made of several questions, one per line, into those questions.
+    
+    Only prompts where every non-empty line ends with "?" are split; anything
+    else is returned whole, as a single question.
+    """
+    lines = [line.strip() for line in question.splitlines() if line.strip()]
+    if len(lines) > 1 and all(line.endswith("?") for line in lines):
+        return lines
+    return [question]
+
+
+def _classify_question(question: str, mode: str = "general") -> Literal["count", "sample", "analyze", "general"]:
+    """
+    Decide how query_impairment_data answers a question.
+    
+    Several questions at once are answered together from sample context. Otherwise
+    count phrasing wins over sample phrasing, and then the requested mode decides
+    between row-by-row analysis and a general answer from sample context.
+    """
+    if len(_split_questions(question)) > 1:
+        return "analyze" if mode == "analyze" else "general"
+    if _is_count_question(question):
+        return "count"
+    if _is_sample_question(question):
+        return "sample"
+    return "analyze" if mode == "analyze" else "general"
+
+
+def _nonempty_text_predicate() -> str:
+    """Return the WHERE predicate selecting rows that have response text."""
+    if HAS_TEXT_COLUMN:
+        return HAS_TEXT_COLUMN
+    return "koo_responseextended IS NOT NULL AND TRIM(koo_responseextended) != ''"
+
+
+def _text_rows_source(catalog: str, schema: str, table: str) -> tuple:
+    """
+    Return (relation, TABLESAMPLE clause, WHERE clause) for reading rows that have response text.
+    
+    For the default table, FILTERED_TABLE is read instead when configured; it only
+    holds such rows, so neither a filter nor sampling is applied and LIMIT stops
+    after `limit` rows. Otherwise the table is filtered and, when SAMPLE_PERCENT
+    is set, sampled; see _tablesample_clause.
+    """
+    if FILTERED_TABLE and (catalog, schema, table) == (DEFAULT_CATALOG, DEFAULT_SCHEMA, DEFAULT_TABLE):
+        return FILTERED_TABLE, "", ""
+    return f"{catalog}.{schema}.{table}", _tablesample_clause(), f"WHERE {_nonempty_text_predicate()}"
+
+
+def _tablesample_clause() -> str:
+    """Return the TABLESAMPLE clause used when sampling records, or "" unless SAMPLE_PERCENT is set."""
+    if SAMPLE_PERCENT <= 0:
+        return ""
+    percent = f"{SAMPLE_PERCENT:.10f}".rstrip("0").rstrip(".")
+    return f"TABLESAMPLE ({percent} PERCENT) REPEATABLE ({SAMPLE_SEED})"
+
+
+@functools.lru_cache(maxsize=32)
+def _render_sql(template: string.Template, **values) -> str:
+    """
+    Substitute table settings into a SQL template, caching the result.
+    
+    The values are the same for nearly every call, so the statement text is
+    built once and the identical string is reused, keeping warehouse-side
+    statement caching effective.
+    """
+    return template.substitute(**values)
+
+
+@functools.lru_cache(maxsize=16)
 def build_count_query_sql(
     catalog: str = DEFAULT_CATALOG,
     schema: str = DEFAULT_SCHEMA,
@@ -174,23 +830,31 @@ def build_count_query_sql(
     return f"SELECT COUNT(*) AS total_records FROM {catalog}.{schema}.{table}"
 
 
+@functools.lru_cache(maxsize=16)
 def build_sample_query_sql(
     catalog: str = DEFAULT_CATALOG,
     schema: str = DEFAULT_SCHEMA,
     table: str = DEFAULT_TABLE,
-    limit: int = 5
+    limit: int = 5,
+    preview_chars: int = 200
 ) -> str:
-    """Build a SQL query to get sample records from the table."""
+    """
+    Build a SQL query to get sample records from the table.
+    
+    Only the first `preview_chars` characters of the response text are returned
+    (as koo_responseextended_preview), so multi-KB texts are not shipped in full.
+    The text is cached per argument combination, as the defaults rarely change.
+    """
+    source, tablesample, text_filter = _text_rows_source(catalog, schema, table)
     return f"""
     SELECT 
         koo_chimeasureresponseid,
         koo_clientid,
-        koo_responseextended,
+        SUBSTRING(koo_responseextended, 1, {preview_chars}) AS koo_responseextended_preview,
         koo_appcode,
         createdon
-    FROM {catalog}.{schema}.{table}
-    WHERE koo_responseextended IS NOT NULL 
-      AND TRIM(koo_responseextended) != ''
+    FROM {source} {tablesample}
+    {text_filter}
     LIMIT {limit}
     """.strip()
 
@@ -199,38 +863,85 @@ def build_ai_query_with_data_sql(
     user_question: str,
     data_context: str,
     endpoint: str = DEFAULT_ENDPOINT
-) -> str:
+) -> tuple:
     """
     Build a SQL query that uses ai_query with actual data context.
     
+    The SQL text is constant; the endpoint and prompt are passed as named
+    parameters, so no quote escaping is needed and the warehouse sees the
+    same statement for every question.
+    
     Args:
         user_question: The user's natural language question
         data_context: Actual data from the database to include in the prompt
         endpoint: The model serving endpoint name
         
     Returns:
-        SQL query string using ai_query function
+        Tuple of (SQL query string, parameters dict) for _execute_sql
     """
-    escaped_question = user_question.replace("'", "''")
-    escaped_data = data_context.replace("'", "''")
-    
-    prompt = f"""You are a healthcare data analyst assistant analyzing the measureresponses_impairment table.
+    prompt = _PROMPT_TEMPLATE.substitute(data=data_context, question=user_question)
+    return AI_QUERY_WITH_DATA_SQL, {"endpoint": endpoint, "prompt": prompt}
 
-Here is the actual data from the database:
-{escaped_data}
 
-User question: {escaped_question}
+def _summary_context(catalog: str, schema: str, table: str, total_records: int = None) -> str:
+    """Return the data context used when no sample records could be fetched."""
+    if total_records is not None:
+        return f"Total records in {catalog}.{schema}.{table}: {total_records:,} (unable to fetch sample data)"
+    return f"Table: {catalog}.{schema}.{table} (unable to fetch sample data)"
 
-Based on the actual data provided above, please answer the user's question directly and accurately."""
 
-    escaped_prompt = prompt.replace("'", "''")
+def build_general_query_sql(
+    user_question: str,
+    endpoint: str = DEFAULT_ENDPOINT,
+    catalog: str = DEFAULT_CATALOG,
+    schema: str = DEFAULT_SCHEMA,
+    table: str = DEFAULT_TABLE,
+    limit: int = 3,
+    preview_chars: int = 150,
+    total_records: int = None
+) -> tuple:
+    """
+    Build a single SQL query that samples records and answers the question from them.
     
-    return f"""
-    SELECT ai_query(
-        '{endpoint}',
-        '{escaped_prompt}'
-    ) AS response
-    """.strip()
+    Equivalent to fetching build_sample_query_sql rows and passing their previews
+    to build_ai_query_with_data_sql, but in one statement. Each result row holds
+    the sampled records and the model's response; a prompt of several questions
+    (see _split_questions) yields one row per question, in order. When the sample
+    has no usable text, the model is given _summary_context instead.
+    
+    Args:
+        user_question: The user's natural language question(s)
+        endpoint: The model serving endpoint name
+        catalog: The catalog name
+        schema: The schema name
+        table: The table name
+        limit: Number of sample records to include as context
+        preview_chars: Characters of each record's text to include
+        total_records: The table's row count if already known, for the summary context
+        
+    Returns:
+        Tuple of (SQL query string, parameters dict) for _execute_sql
+    """
+    questions = _split_questions(user_question)
+    source, tablesample, text_filter = _text_rows_source(catalog, schema, table)
+    query = _render_sql(
+        _GENERAL_QUERY_SQL_TEMPLATE,
+        source=source,
+        tablesample=tablesample,
+        text_filter=text_filter,
+        limit=limit,
+        preview_chars=preview_chars,
+        prompt_suffixes=", ".join(f":prompt_suffix_{i}" for i in range(len(questions)))
+    )
+    parameters = {
+        "endpoint": endpoint,
+        "empty_context": _summary_context(catalog, schema, table, total_records),
+        "context_header": f"Sample records from {catalog}.{schema}.{table}:\n",
+        "prompt_prefix": _PROMPT_PREFIX
+    }
+    for i, question in enumerate(questions):
+        parameters[f"prompt_suffix_{i}"] = _PROMPT_SUFFIX_TEMPLATE.substitute(question=question)
+    return query, parameters
 
 
 def build_data_analysis_sql(
@@ -239,12 +950,17 @@ def build_data_analysis_sql(
     catalog: str = DEFAULT_CATALOG,
     schema: str = DEFAULT_SCHEMA,
     table: str = DEFAULT_TABLE,
-    limit: int = 10
-) -> str:
+    limit: int = 10,
+    batch_size: int = 10
+) -> tuple:
     """
     Build a SQL query that analyzes actual data from the table using ai_query.
     
-    This query samples records and uses ai_query to analyze them based on the user's question.
+    This query samples records and groups them into batches of `batch_size`, so
+    ai_query is invoked once per batch instead of once per row. The batch is sent
+    as a JSON array and the model is asked to answer with a JSON array keyed by
+    record id. Each result row holds the batch's records (id and a 100-character
+    preview) and the raw model answer; see _parse_record_analyses.
     
     Args:
         user_question: The user's natural language question
@@ -253,38 +969,182 @@ def build_data_analysis_sql(
         schema: The schema name
         table: The table name
         limit: Maximum number of records to analyze
+        batch_size: Maximum number of records sent to the model in one ai_query call
         
     Returns:
-        SQL query string
+        Tuple of (SQL query string, parameters dict) for _execute_sql
     """
-    escaped_question = user_question.replace("'", "''")
+    source, tablesample, text_filter = _text_rows_source(catalog, schema, table)
+    query = _render_sql(
+        _DATA_ANALYSIS_SQL_TEMPLATE,
+        source=source,
+        tablesample=tablesample,
+        text_filter=text_filter,
+        limit=limit,
+        batch_size=batch_size
+    )
+    instruction = _ANALYSIS_PROMPT_PREFIX + user_question + _ANALYSIS_RESPONSE_FORMAT
+    return query, {"endpoint": endpoint, "instruction": instruction}
+
+
+def _execute_sql(query: str, user_token: str = None, parameters: dict = None) -> dict:
+    """Execute SQL with user token or service principal fallback."""
+    def run():
+        if user_token:
+            return _execute_sql_with_user_token(query, user_token, parameters)
+        return _execute_sql_with_service_principal(query, parameters)
     
-    sql = f"""
-    SELECT 
-        koo_chimeasureresponseid,
-        koo_responseextended,
-        ai_query(
-            '{endpoint}',
-            CONCAT(
-                'Analyze this healthcare response text and answer the following question: {escaped_question}\\n\\nText: ',
-                COALESCE(koo_responseextended, 'No text available')
-            )
-        ) AS analysis
-    FROM {catalog}.{schema}.{table}
-    WHERE koo_responseextended IS NOT NULL 
-      AND TRIM(koo_responseextended) != ''
-    LIMIT {limit}
+    result = run()
+    # An auto-selected warehouse may have been deleted since it was picked. Only a
+    # failure to connect is retried: the statement was never submitted, so it cannot
+    # run twice, and failures after submission (or pool timeouts) are returned as is.
+    if (
+        not result["success"]
+        and result.get("warehouse_unavailable")
+        and _invalidate_warehouse_pick()
+    ):
+        logger.warning("Could not connect to auto-selected warehouse, retrying with a fresh pick")
+        result = run()
+    return result
+
+
+# (catalog, schema, table, principal) -> (total_records, expires_at), least recently used first
+_count_cache = collections.OrderedDict()
+_count_cache_lock = threading.Lock()
+
+
+def _cached_record_count(catalog: str, schema: str, table: str, user_token: str = None) -> int:
+    """Return the table's record count if counted recently, or None; never queries the warehouse."""
+    key = (catalog, schema, table, _principal_key(user_token))
+    with _count_cache_lock:
+        cached = _count_cache.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            _count_cache.move_to_end(key)
+            return cached[0]
+    return None
+
+
+def _get_record_count(catalog: str, schema: str, table: str, user_token: str = None) -> dict:
     """
+    Return the table's record count, reusing a recent count for COUNT_CACHE_TTL_SECONDS.
     
-    return sql.strip()
+    The cache is per principal because row filters can give users different counts.
+    Principals are keyed by token, which the proxy rotates, so expired entries are
+    dropped whenever a count is stored and at most COUNT_CACHE_SIZE are kept.
+    
+    Returns:
+        Dictionary with "total_records" on success, or the failed query result.
+    """
+    total_records = _cached_record_count(catalog, schema, table, user_token)
+    if total_records is not None:
+        return {"success": True, "total_records": total_records}
+    
+    key = (catalog, schema, table, _principal_key(user_token))
+    count_query = build_count_query_sql(catalog, schema, table)
+    logger.info(f"Executing count query: {count_query}")
+    
+    count_result = _execute_sql(count_query, user_token)
+    if not count_result["success"]:
+        return count_result
+    
+    count_table = count_result["arrow_table"]
+    total_records = count_table.column(0)[0].as_py() if count_table.num_rows else 0
+    if _no_store.get():
+        return {"success": True, "total_records": total_records}
+    now = time.monotonic()
+    with _count_cache_lock:
+        for expired_key in [k for k, (_, expires_at) in _count_cache.items() if expires_at <= now]:
+            del _count_cache[expired_key]
+        _count_cache[key] = (total_records, now + COUNT_CACHE_TTL_SECONDS)
+        _count_cache.move_to_end(key)
+        while len(_count_cache) > COUNT_CACHE_SIZE:
+            _count_cache.popitem(last=False)
+    return {"success": True, "total_records": total_records}
 
 
-def _execute_sql(query: str, user_token: str = None) -> dict:
-    """Execute SQL with user token or service principal fallback."""
-    if user_token:
-        return _execute_sql_with_user_token(query, user_token)
-    else:
-        return _execute_sql_with_service_principal(query)
+# (endpoint, normalized question, data context digest) -> (result, expires_at)
+_ai_query_cache = collections.OrderedDict()
+_ai_query_cache_lock = threading.Lock()
+
+
+# Politeness phrases that open a question without changing what is asked
+_FILLER_PREFIX_RE = re.compile(r"^(?:(?:please|can you|could you|would you|tell me)\b[\s,]*)+")
+
+
+def normalize_question(question: str) -> str:
+    """
+    Reduce a question to a canonical form so trivial rephrasings share a cache entry.
+    
+    Only case, whitespace, trailing "?!." and leading politeness phrases are
+    ignored. Every other character, including digits, signs and comparison
+    operators, is kept, so questions that differ in substance (e.g. "> 5" vs
+    "< 5") never share an answer.
+    """
+    normalized = " ".join(question.lower().split()).rstrip("?!. ")
+    return _FILLER_PREFIX_RE.sub("", normalized)
+
+
+def _execute_ai_query_with_data(
+    user_question: str,
+    data_context: str,
+    endpoint: str,
+    user_token: str = None
+) -> dict:
+    """
+    Run ai_query over the given data context, reusing a recent answer when possible.
+    
+    The cache key hashes the data context, so an entry stops matching as soon as
+    the underlying data (e.g. the record count) changes. Only successful results
+    are cached.
+    """
+    key = (
+        endpoint,
+        normalize_question(user_question),
+        hashlib.blake2b(data_context.encode("utf-8"), digest_size=16).digest()
+    )
+    with _ai_query_cache_lock:
+        cached = _ai_query_cache.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            _ai_query_cache.move_to_end(key)
+            logger.info("Reusing cached ai_query answer")
+            return cached[0]
+    
+    ai_query, ai_query_params = build_ai_query_with_data_sql(user_question, data_context, endpoint)
+    result = _execute_sql(ai_query, user_token, ai_query_params)
+    
+    if result["success"] and not _no_store.get():
+        with _ai_query_cache_lock:
+            _ai_query_cache[key] = (result, time.monotonic() + AI_QUERY_CACHE_TTL_SECONDS)
+            _ai_query_cache.move_to_end(key)
+            while len(_ai_query_cache) > AI_QUERY_CACHE_SIZE:
+                _ai_query_cache.popitem(last=False)
+    return result
+
+
+def _parse_record_analyses(analysis: str) -> dict:
+    """
+    Parse a batched analysis answer into {record id: analysis}.
+    
+    Models often wrap JSON in a markdown code fence, so only the outermost
+    [...] span is parsed. Returns an empty dict if the answer is not a JSON
+    array of {"id", "analysis"} objects.
+    """
+    if not analysis:
+        return {}
+    start, end = analysis.find("["), analysis.rfind("]")
+    if start == -1 or end < start:
+        return {}
+    try:
+        items = json.loads(analysis[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+    return {
+        str(item["id"]): str(item["analysis"])
+        for item in items
+        if isinstance(item, dict) and "id" in item and "analysis" in item
+    }
 
 
 def query_impairment_data(
@@ -294,7 +1154,8 @@ def query_impairment_data(
     catalog: str = DEFAULT_CATALOG,
     schema: str = DEFAULT_SCHEMA,
     table: str = DEFAULT_TABLE,
-    user_token: str = None
+    user_token: str = None,
+    no_store: bool = False
 ) -> dict:
     """
     Query the impairment data table using ai_query based on user's natural language question.
@@ -313,31 +1174,36 @@ def query_impairment_data(
         schema: The schema name
         table: The table name
         user_token: The user's access token from X-Forwarded-Access-Token header (optional)
+        no_store: Keep nothing from this call, for requests sent with Cache-Control: no-store.
+            The warehouse connection is closed afterwards and no count or answer is cached.
         
     Returns:
-        Dictionary containing the response or error information
+        Dictionary containing the response or error information. When the answer
+        was based on fetched rows, "records" holds them as a pyarrow.Table that
+        can be passed directly to st.dataframe.
     """
+    no_store_token = _no_store.set(no_store)
     try:
+        # Arrow table of the records the answer was based on, returned for display
+        source_records = None
+        
         # Step 1: Detect question type and fetch relevant data
-        if _is_count_question(user_question):
+        kind = _classify_question(user_question, mode)
+        
+        if kind == "count":
             # For count questions, get the actual count first
-            count_query = build_count_query_sql(catalog, schema, table)
-            logger.info(f"Executing count query: {count_query}")
-            
-            count_result = _execute_sql(count_query, user_token)
+            count_result = _get_record_count(catalog, schema, table, user_token)
             if not count_result["success"]:
                 return count_result
             
-            total_records = count_result["results"][0].get("total_records", 0)
+            total_records = count_result["total_records"]
             data_context = f"Total records in {catalog}.{schema}.{table}: {total_records:,}"
             
             # Use ai_query to format a nice response with the actual data
-            ai_query = build_ai_query_with_data_sql(user_question, data_context, endpoint)
             logger.info(f"Executing ai_query with count data...")
+            result = _execute_ai_query_with_data(user_question, data_context, endpoint, user_token)
             
-            result = _execute_sql(ai_query, user_token)
-            
-        elif _is_sample_question(user_question):
+        elif kind == "sample":
             # For sample questions, fetch actual sample data
             sample_query = build_sample_query_sql(catalog, schema, table, limit=5)
             logger.info(f"Executing sample query: {sample_query[:100]}...")
@@ -346,23 +1212,22 @@ def query_impairment_data(
             if not sample_result["success"]:
                 return sample_result
             
-            # Format sample data for context
-            sample_rows = sample_result["results"]
-            data_lines = []
-            for i, row in enumerate(sample_rows, 1):
-                text_preview = str(row.get("koo_responseextended", ""))[:200]
-                data_lines.append(f"Record {i}: {text_preview}...")
+            # Format sample data for context; only the (already truncated) text column is needed
+            source_records = sample_result["arrow_table"]
+            sample_previews = source_records.column("koo_responseextended_preview").to_pylist()
+            data_lines = [
+                f"Record {i}: {text_preview}..."
+                for i, text_preview in enumerate(sample_previews, 1)
+            ]
             data_context = f"Sample records from {catalog}.{schema}.{table}:\n" + "\n".join(data_lines)
             
             # Use ai_query to explain the sample data
-            ai_query = build_ai_query_with_data_sql(user_question, data_context, endpoint)
             logger.info(f"Executing ai_query with sample data...")
+            result = _execute_ai_query_with_data(user_question, data_context, endpoint, user_token)
             
-            result = _execute_sql(ai_query, user_token)
-            
-        elif mode == "analyze":
-            # For analysis mode, use row-by-row ai_query on actual data
-            query = build_data_analysis_sql(
+        elif kind == "analyze":
+            # For analysis mode, use batched ai_query calls on actual data
+            query, query_params = build_data_analysis_sql(
                 user_question=user_question,
                 endpoint=endpoint,
                 catalog=catalog,
@@ -371,55 +1236,90 @@ def query_impairment_data(
             )
             logger.info(f"Executing analysis query: {query[:200]}...")
             
-            result = _execute_sql(query, user_token)
+            result = _execute_sql(query, user_token, query_params)
             
-            if result["success"] and result["results"]:
-                # Format analysis results
+            if result["success"] and result["row_count"]:
+                # Format analysis results per record, reading the two result
+                # columns directly instead of building row dicts
+                analysis_table = result["arrow_table"]
                 analyses = []
-                for row in result["results"]:
-                    if isinstance(row, dict):
+                record_count = 0
+                for records, analysis in zip(
+                    analysis_table.column("records").to_pylist(),
+                    analysis_table.column("analysis").to_pylist()
+                ):
+                    records = records or []
+                    record_count += len(records)
+                    per_record = _parse_record_analyses(analysis)
+                    if not per_record:
+                        # The model did not return usable JSON; keep its answer for the whole batch
                         analyses.append({
-                            "id": row.get("koo_chimeasureresponseid", "N/A"),
-                            "text_preview": (str(row.get("koo_responseextended", ""))[:100] + "...") if row.get("koo_responseextended") else "N/A",
-                            "analysis": row.get("analysis", "No analysis available")
+                            "id": ", ".join(str(record["id"]) for record in records) or "N/A",
+                            "text_preview": f"{len(records)} records analyzed together",
+                            "analysis": analysis or "No analysis available"
+                        })
+                        continue
+                    for record in records:
+                        analyses.append({
+                            "id": record["id"] or "N/A",
+                            "text_preview": (record["preview"] + "...") if record["preview"] else "N/A",
+                            "analysis": per_record.get(str(record["id"]), "No analysis available")
                         })
                 return {
                     "success": True,
                     "response": analyses,
                     "mode": "analyze",
-                    "record_count": len(analyses)
+                    "record_count": record_count,
+                    "records": analysis_table
                 }
         else:
-            # For general questions, fetch some sample data for context first
-            sample_query = build_sample_query_sql(catalog, schema, table, limit=3)
-            sample_result = _execute_sql(sample_query, user_token)
-            
-            if sample_result["success"] and sample_result["results"]:
-                sample_rows = sample_result["results"]
-                data_lines = []
-                for i, row in enumerate(sample_rows, 1):
-                    text_preview = str(row.get("koo_responseextended", ""))[:150]
-                    data_lines.append(f"Record {i}: {text_preview}...")
-                data_context = f"Sample records from {catalog}.{schema}.{table}:\n" + "\n".join(data_lines)
-            else:
-                data_context = f"Table: {catalog}.{schema}.{table} (unable to fetch sample data)"
-            
-            # Use ai_query with data context
-            ai_query = build_ai_query_with_data_sql(user_question, data_context, endpoint)
-            logger.info(f"Executing ai_query with context...")
+            # For general questions, sample context and ai_query run as one statement.
+            # A record count is only included in the summary context if already cached.
+            total_records = _cached_record_count(catalog, schema, table, user_token)
+            query, query_params = build_general_query_sql(
+                user_question=user_question,
+                endpoint=endpoint,
+                catalog=catalog,
+                schema=schema,
+                table=table,
+                total_records=total_records
+            )
+            logger.info(f"Executing ai_query with sample context...")
+            result = _execute_sql(query, user_token, query_params)
             
-            result = _execute_sql(ai_query, user_token)
+            if result["success"] and result["row_count"]:
+                sampled = result["arrow_table"].column("records")[0].as_py()
+                if sampled:
+                    source_records = pa.Table.from_pylist(sampled)
+            elif not result["success"]:
+                # Sampling failed; answer from a summary of the table instead, as before fusing
+                logger.warning(f"General query failed, retrying with summary context: {result.get('error')}")
+                data_context = _summary_context(catalog, schema, table, total_records)
+                result = _execute_ai_query_with_data(user_question, data_context, endpoint, user_token)
         
         # Step 2: Process and return results
         if result["success"]:
-            if result["results"]:
-                first_result = result["results"][0]
-                response_text = first_result.get("response", str(first_result)) if isinstance(first_result, dict) else str(first_result)
-                return {
+            if result["row_count"]:
+                result_table = result["arrow_table"]
+                if "response" in result_table.column_names:
+                    answers = result_table.column("response").to_pylist()
+                    questions = _split_questions(user_question)
+                    if len(answers) > 1 and len(answers) == len(questions):
+                        response_text = "\n\n".join(
+                            f"**{question}**\n\n{answer}" for question, answer in zip(questions, answers)
+                        )
+                    else:
+                        response_text = answers[0]
+                else:
+                    response_text = str(result_table.slice(0, 1).to_pylist()[0])
+                response = {
                     "success": True,
                     "response": response_text,
                     "mode": mode
                 }
+                if source_records is not None:
+                    response["records"] = source_records
+                return response
             else:
                 return {
                     "success": True,
@@ -438,6 +1338,8 @@ def query_impairment_data(
             "success": False,
             "error": str(e)
         }
+    finally:
+        _no_store.reset(no_store_token)
 
 
 def format_analysis_response(analysis_results: list) -> str:
@@ -453,11 +1355,24 @@ def format_analysis_response(analysis_results: list) -> str:
     if not analysis_results:
         return "No analysis results available."
     
-    formatted_parts = []
-    for i, result in enumerate(analysis_results, 1):
-        part = f"**Record {i}** (ID: {result.get('id', 'N/A')})\n"
-        part += f"*Preview:* {result.get('text_preview', 'N/A')}\n"
-        part += f"*Analysis:* {result.get('analysis', 'No analysis')}\n"
-        formatted_parts.append(part)
-    
+    formatted_parts = (
+        f"**Record {i}** (ID: {result.get('id', 'N/A')})\n"
+        f"*Preview:* {result.get('text_preview', 'N/A')}\n"
+        f"*Analysis:* {result.get('analysis', 'No analysis')}\n"
+        for i, result in enumerate(analysis_results, 1)
+    )
     return "\n---\n".join(formatted_parts)
+
+
+def warm_up(endpoint: str = DEFAULT_ENDPOINT) -> dict:
+    """
+    Send a 1-token ai_query as the service principal so the warehouse, a pooled
+    connection and the model endpoint are ready before the first real question.
+    
+    Args:
+        endpoint: The model serving endpoint name
+        
+    Returns:
+        Dictionary containing the query results or error information.
+    """
+    return _execute_sql(AI_QUERY_WARM_UP_SQL, parameters={"endpoint": endpoint, "prompt": "hi"})
@@ -1,8 +1,14 @@
+import collections
 import logging
 import os
+import threading
+import time
 import streamlit as st
-from model_serving_utils import query_endpoint, is_endpoint_supported
-from ai_query_utils import query_impairment_data, get_table_info
+from model_serving_utils import query_endpoint, query_endpoint_stream, is_endpoint_supported
+from ai_query_utils import (
+    query_impairment_data, get_table_info, normalize_question, format_analysis_response, warm_up,
+    DEFAULT_ENDPOINT, DEFAULT_CATALOG, DEFAULT_SCHEMA, DEFAULT_TABLE,
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -17,14 +23,41 @@ assert SERVING_ENDPOINT, \
      "'serving_endpoint' with CAN_QUERY permissions, as described in "
      "https://docs.databricks.com/aws/en/generative-ai/agent-framework/chat-app#deploy-the-databricks-app")
 
-# AI Query configuration
-AI_QUERY_ENDPOINT = "databricks-gpt-oss-120b"
-CATALOG = "dev_structured"
-SCHEMA = "analytics"
-TABLE = "measureresponses_impairment"
+# Set PREWARM_ENDPOINTS=true to warm the serving endpoint and the warehouse once per process
+PREWARM_ENDPOINTS = os.getenv('PREWARM_ENDPOINTS', 'false').lower() == 'true'
+
+# AI Query configuration, defined once in ai_query_utils
+AI_QUERY_ENDPOINT = DEFAULT_ENDPOINT
+CATALOG = DEFAULT_CATALOG
+SCHEMA = DEFAULT_SCHEMA
+TABLE = DEFAULT_TABLE
+
+# Query modes offered in the sidebar, with the intro text and input placeholder for each
+DATA_QUERY_MODE = "Data Query (ai_query)"
+GENERAL_CHAT_MODE = "General Chat"
+MODE_INTROS = {
+    DATA_QUERY_MODE: (
+        "Ask questions about the **healthcare impairment data** in natural language. "
+        "Your questions will be processed using Databricks `ai_query` function."
+    ),
+    GENERAL_CHAT_MODE: (
+        "General chat mode. See "
+        "[Databricks docs](https://docs.databricks.com/aws/en/generative-ai/agent-framework/chat-app) "
+        "for more information."
+    ),
+}
+PLACEHOLDERS = {
+    DATA_QUERY_MODE: "Ask about impairment data...",
+    GENERAL_CHAT_MODE: "What is up?",
+}
+
+@st.cache_resource(ttl=600, show_spinner=False)
+def _endpoint_supported(endpoint_name):
+    """Check the endpoint's task type once per process instead of on every rerun."""
+    return is_endpoint_supported(endpoint_name)
 
 # Check if the endpoint is supported
-endpoint_supported = is_endpoint_supported(SERVING_ENDPOINT)
+endpoint_supported = _endpoint_supported(SERVING_ENDPOINT)
 
 def get_user_info():
     headers = st.context.headers
@@ -38,14 +71,173 @@ def get_user_token():
     """Extract user access token from Databricks App request headers."""
     return st.context.headers.get('X-Forwarded-Access-Token')
 
-user_info = get_user_info()
+def get_no_store():
+    """Whether the request asked for nothing derived from it to be cached (Cache-Control: no-store)."""
+    return "no-store" in st.context.headers.get("Cache-Control", "").lower()
+
+# The identity headers are fixed for a session; the token is re-read since the proxy refreshes it
+if "user_info" not in st.session_state:
+    st.session_state.user_info = get_user_info()
+user_info = st.session_state.user_info
 user_token = get_user_token()
+no_store = get_no_store()
+
+def _warm_up_endpoints():
+    """Send a 1-token chat request and a 1-token ai_query so the first real prompt hits warm endpoints."""
+    try:
+        query_endpoint(
+            endpoint_name=SERVING_ENDPOINT,
+            messages=[{"role": "user", "content": "hi"}],
+            max_tokens=1,
+        )
+    except Exception as e:
+        logger.warning(f"Serving endpoint warm-up failed: {e}")
+    result = warm_up(AI_QUERY_ENDPOINT)
+    if not result["success"]:
+        logger.warning(f"ai_query warm-up failed: {result.get('error')}")
+
+@st.cache_resource
+def _prewarm_endpoints():
+    """Start the background warm-up once per process, as the service principal."""
+    threading.Thread(target=_warm_up_endpoints, daemon=True).start()
+    return True
+
+if PREWARM_ENDPOINTS and endpoint_supported:
+    _prewarm_endpoints()
+
+@st.cache_data(ttl=600, max_entries=512, show_spinner=False)
+def _cached_query_impairment_data(question_key, mode, endpoint, catalog, schema, table, user_id, _user_token, _user_question):
+    """
+    Memoize successful data queries so repeated questions skip the warehouse round-trip.
+    
+    Results are keyed by the normalized question (see normalize_question), so
+    rephrasings that differ only in case, punctuation or politeness share an answer.
+    They are keyed by user_id as well, so an answer produced with one user's
+    permissions is never served to another. The token and the question as typed
+    are excluded from the cache key (leading underscore). Failures raise so they
+    are not cached.
+    """
+    result = query_impairment_data(
+        user_question=_user_question,
+        user_token=_user_token,
+        mode=mode,
+        endpoint=endpoint,
+        catalog=catalog,
+        schema=schema,
+        table=table
+    )
+    if not result["success"]:
+        raise RuntimeError(result.get("error", "Unknown error"))
+    return result
+
+def run_data_query(user_question, mode="general"):
+    """Answer a data question, reusing a cached answer when the same question was asked recently (unless no-store)."""
+    if no_store:
+        return query_impairment_data(
+            user_question=user_question,
+            user_token=user_token,
+            mode=mode,
+            endpoint=AI_QUERY_ENDPOINT,
+            catalog=CATALOG,
+            schema=SCHEMA,
+            table=TABLE,
+            no_store=True
+        )
+    try:
+        return _cached_query_impairment_data(
+            normalize_question(user_question), mode, AI_QUERY_ENDPOINT, CATALOG, SCHEMA, TABLE,
+            user_info["user_id"], user_token, user_question
+        )
+    except RuntimeError as e:
+        return {"success": False, "error": str(e)}
+
+# Approximate token budget (~4 characters per token) for the history sent to the endpoint
+CHAT_HISTORY_TOKEN_BUDGET = 6000
+
+# General Chat answers kept for replaying an identical conversation
+CHAT_CACHE_SIZE = 256
+CHAT_CACHE_TTL_SECONDS = 300
+
+@st.cache_resource
+def _chat_response_cache():
+    """
+    Process-wide (lock, LRU) of General Chat answers.
+    
+    Streamed answers are only known once the stream finishes, so they are stored
+    here by stream_chat_response rather than memoized with st.cache_data.
+    """
+    return threading.Lock(), collections.OrderedDict()
+
+def trim_history(messages, token_budget=CHAT_HISTORY_TOKEN_BUDGET):
+    """
+    Return the most recent messages that fit in the token budget.
+    
+    The latest message is always kept, so the current prompt is never dropped;
+    the full history stays in st.session_state for display.
+    """
+    trimmed = []
+    total = 0
+    for message in reversed(messages):
+        total += len(message["content"]) // 4 + 1
+        if trimmed and total > token_budget:
+            break
+        trimmed.append(message)
+    trimmed.reverse()
+    return trimmed
+
+def stream_chat_response(messages, max_tokens=400):
+    """
+    Yield the assistant's reply to the conversation as it is generated.
+    
+    Only the recent turns that fit CHAT_HISTORY_TOKEN_BUDGET are sent. They are
+    keyed as a tuple of (role, content) pairs; an answer to an identical recent
+    conversation is replayed from cache in a single chunk.
+    """
+    messages = trim_history(messages)
+    key = (SERVING_ENDPOINT, max_tokens, tuple((m["role"], m["content"]) for m in messages))
+    lock, cache = _chat_response_cache()
+    with lock:
+        cached = cache.get(key)
+        if cached is not None and cached[1] <= time.monotonic():
+            cached = None
+        elif cached is not None:
+            cache.move_to_end(key)
+    if cached is not None:
+        yield cached[0]
+        return
+    
+    chunks = []
+    for chunk in query_endpoint_stream(endpoint_name=SERVING_ENDPOINT, messages=messages, max_tokens=max_tokens):
+        chunks.append(chunk)
+        yield chunk
+    
+    # Empty answers are not worth replaying, and no-store requests are never kept
+    if no_store or not "".join(chunks):
+        return
+    with lock:
+        cache[key] = ("".join(chunks), time.monotonic() + CHAT_CACHE_TTL_SECONDS)
+        cache.move_to_end(key)
+        while len(cache) > CHAT_CACHE_SIZE:
+            cache.popitem(last=False)
+
+def _start_generating():
+    """Disable the chat input as soon as a prompt is submitted, until its answer is shown."""
+    st.session_state.disabled = True
+
+def _clear_chat_history():
+    """Reset the conversation; runs before the rerun the button click triggers."""
+    st.session_state.messages = []
+    st.session_state.last_records = None
 
 # Streamlit app
 if "visibility" not in st.session_state:
     st.session_state.visibility = "visible"
     st.session_state.disabled = False
 
+# Seconds from submitting each prompt to its answer being shown, for the sidebar chart
+if "latencies" not in st.session_state:
+    st.session_state.latencies = []
+
 st.title("Healthcare Impairment Data Assistant")
 
 # Check if endpoint is supported and show appropriate UI
@@ -63,84 +255,100 @@ else:
         st.header("Query Mode")
         query_mode = st.radio(
             "Select how to interact:",
-            options=["Data Query (ai_query)", "General Chat"],
+            options=[DATA_QUERY_MODE, GENERAL_CHAT_MODE],
             index=0,
             help="Data Query uses ai_query to answer questions about the impairment data table. General Chat uses the standard chat endpoint."
         )
         
-        if query_mode == "Data Query (ai_query)":
+        if query_mode == DATA_QUERY_MODE:
             st.info(f"**Connected to:**\n- Table: `{CATALOG}.{SCHEMA}.{TABLE}`\n- Endpoint: `{AI_QUERY_ENDPOINT}`")
             
             with st.expander("Table Information"):
                 st.markdown(get_table_info())
         
-        if st.button("Clear Chat History"):
-            st.session_state.messages = []
-            st.rerun()
+        st.button("Clear Chat History", on_click=_clear_chat_history)
+        st.button("Refresh endpoint status", on_click=_endpoint_supported.clear)
+        
+        if st.session_state.latencies:
+            st.subheader("Response Time (s)")
+            st.line_chart(st.session_state.latencies)
 
     # Main chat area
-    if query_mode == "Data Query (ai_query)":
-        st.markdown(
-            "Ask questions about the **healthcare impairment data** in natural language. "
-            "Your questions will be processed using Databricks `ai_query` function."
-        )
-    else:
-        st.markdown(
-            "General chat mode. See "
-            "[Databricks docs](https://docs.databricks.com/aws/en/generative-ai/agent-framework/chat-app) "
-            "for more information."
-        )
+    st.markdown(MODE_INTROS[query_mode])
 
     # Initialize chat history
     if "messages" not in st.session_state:
         st.session_state.messages = []
+    
+    # (message index, Arrow table) of the records behind the latest answer, if any
+    if "last_records" not in st.session_state:
+        st.session_state.last_records = None
 
     # Display chat messages from history on app rerun
-    for message in st.session_state.messages:
+    for index, message in enumerate(st.session_state.messages):
         with st.chat_message(message["role"]):
             st.markdown(message["content"])
+            if st.session_state.last_records and st.session_state.last_records[0] == index:
+                # Arrow tables are handed to Streamlit as-is, without a pandas copy
+                with st.expander("Records used for this answer"):
+                    st.dataframe(st.session_state.last_records[1])
 
-    # Accept user input
-    placeholder_text = "Ask about impairment data..." if query_mode == "Data Query (ai_query)" else "What is up?"
-    if prompt := st.chat_input(placeholder_text):
+    # Accept user input; disabled while an answer is being generated to prevent double submits
+    placeholder_text = PLACEHOLDERS[query_mode]
+    if prompt := st.chat_input(placeholder_text, disabled=st.session_state.disabled, on_submit=_start_generating):
         # Add user message to chat history
         st.session_state.messages.append({"role": "user", "content": prompt})
         # Display user message in chat message container
         with st.chat_message("user"):
             st.markdown(prompt)
 
-        # Display assistant response in chat message container
-        with st.chat_message("assistant"):
-            if query_mode == "Data Query (ai_query)":
-                # Use ai_query to process the question
-                with st.spinner("Querying impairment data..."):
-                    result = query_impairment_data(
-                        user_question=prompt,
-                        user_token=user_token,
-                        mode="general",
-                        endpoint=AI_QUERY_ENDPOINT,
-                        catalog=CATALOG,
-                        schema=SCHEMA,
-                        table=TABLE
-                    )
-                
-                if result["success"]:
-                    assistant_response = result["response"]
-                    if isinstance(assistant_response, list):
-                        # Format analysis results
-                        from ai_query_utils import format_analysis_response
-                        assistant_response = format_analysis_response(assistant_response)
+        started = time.perf_counter()
+        try:
+            # Display assistant response in chat message container
+            with st.chat_message("assistant"):
+                source_records = None
+                if query_mode == DATA_QUERY_MODE:
+                    # Use ai_query to process the question
+                    with st.spinner("Querying impairment data..."):
+                        result = run_data_query(prompt, mode="general")
+                    
+                    if result["success"]:
+                        assistant_response = result["response"]
+                        source_records = result.get("records")
+                        if isinstance(assistant_response, list):
+                            # Format analysis results
+                            assistant_response = format_analysis_response(assistant_response)
+                    else:
+                        assistant_response = f"Error querying data: {result.get('error', 'Unknown error')}"
+                    
+                    st.markdown(assistant_response)
                 else:
-                    assistant_response = f"Error querying data: {result.get('error', 'Unknown error')}"
-            else:
-                # Use standard chat endpoint
-                assistant_response = query_endpoint(
-                    endpoint_name=SERVING_ENDPOINT,
-                    messages=st.session_state.messages,
-                    max_tokens=400,
-                )["content"]
-            
-            st.markdown(assistant_response)
+                    # Use standard chat endpoint, rendering tokens as they arrive
+                    assistant_response = st.write_stream(stream_chat_response(st.session_state.messages))
+                    # write_stream returns a list rather than a string when nothing was streamed
+                    if not isinstance(assistant_response, str):
+                        assistant_response = "".join(str(part) for part in assistant_response)
+                    if not assistant_response:
+                        assistant_response = "(no response)"
+                        st.markdown(assistant_response)
 
-        # Add assistant response to chat history
-        st.session_state.messages.append({"role": "assistant", "content": assistant_response})
+            latency = time.perf_counter() - started
+            logger.info(f"{query_mode} answer took {latency:.3f}s for a {len(prompt)}-character prompt")
+            st.session_state.latencies.append(round(latency, 3))
+            
+            # Add assistant response to chat history; its records are shown from there on rerun
+            st.session_state.messages.append({"role": "assistant", "content": assistant_response})
+            if source_records is not None:
+                st.session_state.last_records = (len(st.session_state.messages) - 1, source_records)
+            else:
+                st.session_state.last_records = None
+        except Exception as e:
+            # Keep the error in the history; the rerun below would otherwise hide it
+            logger.error(f"Error answering prompt: {e}")
+            st.session_state.messages.append({"role": "assistant", "content": f"Error: {e}"})
+            st.session_state.last_records = None
+        finally:
+            # The input was rendered disabled for this run; rerun once to re-enable it,
+            # also when the answer failed
+            st.session_state.disabled = False
+            st.rerun()
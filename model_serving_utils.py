@@ -61,3 +61,36 @@ def query_endpoint(endpoint_name, messages, max_tokens):
     returns the last message
     ."""
     return _query_endpoint(endpoint_name, messages, max_tokens)[-1]
+
+def query_endpoint_stream(endpoint_name, messages, max_tokens):
+    """
+    Query a chat-completions or agent serving endpoint, yielding the response
+    text as it is generated instead of waiting for the full completion.
+    If the stream carries no text in a recognized delta shape, the endpoint is
+    queried once more without streaming and that answer is yielded instead.
+    """
+    _validate_endpoint_task_type(endpoint_name)
+    
+    chunks = get_deploy_client('databricks').predict_stream(
+        endpoint=endpoint_name,
+        inputs={'messages': messages, "max_tokens": max_tokens},
+    )
+    streamed = False
+    for chunk in chunks:
+        # Chat completions chunks carry choices[0].delta; agent endpoints a top-level delta
+        if chunk.get("choices"):
+            content = chunk["choices"][0].get("delta", {}).get("content")
+        else:
+            content = chunk.get("delta", {}).get("content")
+        
+        # The content may be a list of structured objects, as in _query_endpoint
+        if isinstance(content, list):
+            content = "".join([part.get("text", "") for part in content if part.get("type") == "text"])
+        if content:
+            streamed = True
+            yield content
+    
+    if not streamed:
+        content = query_endpoint(endpoint_name, messages, max_tokens).get("content")
+        if content:
+            yield content
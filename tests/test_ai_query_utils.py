@@ -0,0 +1,135 @@
+import unittest
+from unittest import mock
+
+import pyarrow as pa
+
+import ai_query_utils
+
+
+def _fake_execute_sql(general_result):
+    """Return an _execute_sql stand-in answering count, general and plain ai_query statements."""
+    calls = []
+
+    def execute_sql(query, user_token=None, parameters=None):
+        calls.append((query, parameters))
+        if query.startswith("SELECT COUNT(*)"):
+            table = pa.table({"total_records": [1234]})
+        elif query == ai_query_utils.AI_QUERY_WITH_DATA_SQL:
+            table = pa.table({"response": ["summary answer"]})
+        else:
+            return general_result
+        return {"success": True, "arrow_table": table, "row_count": table.num_rows}
+
+    return execute_sql, calls
+
+
+class GeneralQueryFallbackTest(unittest.TestCase):
+
+    def test_empty_sample_uses_summary_context(self):
+        query, parameters = ai_query_utils.build_general_query_sql("What is in the table?", total_records=1234)
+        self.assertIn("WHEN COUNT(koo_responseextended_preview) = 0 THEN :empty_context", query)
+        self.assertIn("1,234", parameters["empty_context"])
+        self.assertIn("unable to fetch sample data", parameters["empty_context"])
+
+    def test_empty_sample_returns_answer_without_records(self):
+        records_type = pa.list_(pa.struct([("koo_chimeasureresponseid", pa.string())]))
+        table = pa.table({
+            "records": pa.array([[]], type=records_type),
+            "response": ["answer from summary"]
+        })
+        execute_sql, _ = _fake_execute_sql({"success": True, "arrow_table": table, "row_count": 1})
+        with mock.patch.object(ai_query_utils, "_execute_sql", execute_sql):
+            result = ai_query_utils.query_impairment_data("What is in the table?", table="empty_sample")
+        self.assertTrue(result["success"])
+        self.assertEqual(result["response"], "answer from summary")
+        self.assertNotIn("records", result)
+
+    def test_failed_sample_falls_back_to_summary_context(self):
+        execute_sql, calls = _fake_execute_sql({"success": False, "error": "sample failed"})
+        with mock.patch.object(ai_query_utils, "_execute_sql", execute_sql):
+            result = ai_query_utils.query_impairment_data("What is in the table?", table="failed_sample")
+        self.assertTrue(result["success"])
+        self.assertEqual(result["response"], "summary answer")
+        self.assertFalse(any(query.startswith("SELECT COUNT(*)") for query, _ in calls))
+        query, parameters = calls[-1]
+        self.assertEqual(query, ai_query_utils.AI_QUERY_WITH_DATA_SQL)
+        self.assertIn("Table: dev_structured.analytics.failed_sample", parameters["prompt"])
+        self.assertIn("unable to fetch sample data", parameters["prompt"])
+
+    def test_summary_context_uses_a_cached_count(self):
+        execute_sql, calls = _fake_execute_sql({"success": False, "error": "sample failed"})
+        with mock.patch.object(ai_query_utils, "_execute_sql", execute_sql):
+            ai_query_utils.query_impairment_data("How many records?", table="counted_sample")
+            ai_query_utils.query_impairment_data("What is in the table?", table="counted_sample")
+        self.assertEqual(sum(query.startswith("SELECT COUNT(*)") for query, _ in calls), 1)
+        _, parameters = calls[-1]
+        self.assertIn("Total records in dev_structured.analytics.counted_sample: 1,234", parameters["prompt"])
+
+
+class NoStoreTest(unittest.TestCase):
+
+    def test_no_store_caches_neither_count_nor_answer(self):
+        execute_sql, _ = _fake_execute_sql({"success": False, "error": "unused"})
+        answers_before = len(ai_query_utils._ai_query_cache)
+        with mock.patch.object(ai_query_utils, "_execute_sql", execute_sql):
+            result = ai_query_utils.query_impairment_data("How many records?", table="no_store", no_store=True)
+        self.assertTrue(result["success"])
+        self.assertFalse(any(key[2] == "no_store" for key in ai_query_utils._count_cache))
+        self.assertEqual(len(ai_query_utils._ai_query_cache), answers_before)
+        self.assertFalse(ai_query_utils._no_store.get())
+
+
+class WarehouseRetryTest(unittest.TestCase):
+
+    def _run_against(self, result):
+        calls = []
+
+        def execute_on_warehouse(query, parameters=None, user_token=None):
+            calls.append(query)
+            return result
+
+        with mock.patch.object(ai_query_utils, "_execute_on_warehouse", execute_on_warehouse), \
+                mock.patch.object(ai_query_utils, "_warehouse_pick", ("stale-warehouse", float("inf"))):
+            ai_query_utils._execute_sql("SELECT 1")
+        return calls
+
+    def test_connect_failure_retries_with_a_fresh_pick(self):
+        calls = self._run_against({"success": False, "error": "gone", "warehouse_unavailable": True})
+        self.assertEqual(len(calls), 2)
+
+    def test_pool_timeout_is_not_retried(self):
+        calls = self._run_against({
+            "success": False,
+            "error": "No warehouse connection became available within 30 seconds"
+        })
+        self.assertEqual(len(calls), 1)
+
+
+class NormalizeQuestionTest(unittest.TestCase):
+
+    def test_trivial_rephrasings_share_a_key(self):
+        self.assertEqual(
+            ai_query_utils.normalize_question("Please, can you tell me how many records?"),
+            ai_query_utils.normalize_question("how   many RECORDS")
+        )
+
+    def test_operators_and_signs_give_distinct_keys(self):
+        questions = [
+            "records with score > 5",
+            "records with score < 5",
+            "records with score >= 5",
+            "records with score >= -5",
+            "records with score != 5",
+            "records with score = 5",
+            "records with score 5",
+            "records with score 5%",
+            "records with score +5",
+            "records with score 0.5",
+            "records with score 5/10",
+        ]
+        keys = {ai_query_utils.normalize_question(question) for question in questions}
+        self.assertEqual(len(keys), len(questions))
+
+
+if __name__ == "__main__":
+    unittest.main()